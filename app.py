@@ -1,5 +1,10 @@
+import csv
+import math
+import os
+import shutil
 import sqlite3
 from datetime import date, datetime, timedelta
+from functools import lru_cache
 from typing import List, Dict, Any
 
 import pandas as pd
@@ -58,141 +63,153 @@ CHEMO_TEMPLATES: Dict[str, List[Dict[str, Any]]] = {
 }
 
 
+@st.cache_resource
 def get_conn() -> sqlite3.Connection:
-    return sqlite3.connect(DB_PATH, check_same_thread=False)
+    """
+    เปิด SQLite connection เดียวต่อ process แล้ว cache ไว้ (st.cache_resource)
+    จะได้ไม่ต้องจ่ายค่า open/close ทุกครั้งที่ Streamlit rerun
+    """
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, cached_statements=256)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-20000")
+    conn.execute("PRAGMA mmap_size=268435456")
+    conn.execute("PRAGMA wal_autocheckpoint=1000")
+    conn.execute("PRAGMA busy_timeout=5000")
+    return conn
+
+
+_SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS hospitals(
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL UNIQUE
+);
+
+CREATE TABLE IF NOT EXISTS wards(
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    hospital_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    FOREIGN KEY(hospital_id) REFERENCES hospitals(id)
+);
+
+CREATE TABLE IF NOT EXISTS patients(
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    patient_name TEXT NOT NULL,
+    mrn TEXT,
+    age INTEGER,
+    sex TEXT,
+    hospital_id INTEGER,
+    ward_id INTEGER,
+    status TEXT,
+    planned_admit_date TEXT,
+    admit_date TEXT,
+    bed TEXT,
+    diagnosis TEXT,
+    responsible_md TEXT,
+    priority TEXT,
+    precautions TEXT,
+    notes TEXT,
+    last_rounded_at TEXT,
+    weight_kg REAL,
+    height_cm REAL,
+    bsa REAL,
+    chemo_regimen TEXT,
+    chemo_total_cycles INTEGER,
+    chemo_interval_days INTEGER,
+    FOREIGN KEY(hospital_id) REFERENCES hospitals(id),
+    FOREIGN KEY(ward_id) REFERENCES wards(id)
+);
+
+CREATE TABLE IF NOT EXISTS rounds(
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    patient_id INTEGER NOT NULL,
+    round_time TEXT NOT NULL,
+    recorder TEXT,
+    notes TEXT,
+    FOREIGN KEY(patient_id) REFERENCES patients(id)
+);
+
+CREATE TABLE IF NOT EXISTS transfers(
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    patient_id INTEGER NOT NULL,
+    from_hospital_id INTEGER,
+    from_ward_id INTEGER,
+    to_hospital_id INTEGER,
+    to_ward_id INTEGER,
+    transfer_time TEXT NOT NULL,
+    notes TEXT,
+    FOREIGN KEY(patient_id) REFERENCES patients(id)
+);
+
+CREATE TABLE IF NOT EXISTS chemo_courses(
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    patient_id INTEGER NOT NULL,
+    cycle INTEGER NOT NULL,
+    date TEXT NOT NULL,
+    regimen TEXT NOT NULL,
+    drug TEXT NOT NULL,
+    dose_mg REAL,
+    dose_factor REAL,
+    notes TEXT,
+    FOREIGN KEY(patient_id) REFERENCES patients(id)
+);
+
+CREATE TABLE IF NOT EXISTS chemo_drugs(
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    course_id INTEGER NOT NULL,
+    regimen_day TEXT NOT NULL,
+    drug_name TEXT NOT NULL,
+    dose_mg REAL,
+    dose_factor REAL DEFAULT 1.0,
+    notes TEXT,
+    FOREIGN KEY(course_id) REFERENCES chemo_courses(id)
+);
+
+CREATE TABLE IF NOT EXISTS chemo_assessments(
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    patient_id INTEGER NOT NULL,
+    cycle_no INTEGER,
+    assess_date TEXT NOT NULL,
+    assess_type TEXT,
+    result_summary TEXT,
+    response TEXT,
+    FOREIGN KEY(patient_id) REFERENCES patients(id)
+);
+
+-- index สำหรับคอลัมน์ที่ใช้ filter/sort บ่อย จะได้ไม่ full scan ทุก rerun
+CREATE INDEX IF NOT EXISTS idx_patients_status ON patients(status);
+CREATE INDEX IF NOT EXISTS idx_patients_hospital ON patients(hospital_id, status);
+CREATE INDEX IF NOT EXISTS idx_patients_ward ON patients(ward_id);
+CREATE INDEX IF NOT EXISTS idx_patients_planned ON patients(planned_admit_date);
+CREATE INDEX IF NOT EXISTS idx_patients_admit ON patients(admit_date);
+CREATE INDEX IF NOT EXISTS idx_patients_status_planned ON patients(status, planned_admit_date);
+CREATE INDEX IF NOT EXISTS idx_patients_status_admit ON patients(status, admit_date);
+CREATE INDEX IF NOT EXISTS idx_rounds_patient ON rounds(patient_id);
+CREATE INDEX IF NOT EXISTS idx_transfers_patient ON transfers(patient_id);
+CREATE INDEX IF NOT EXISTS idx_chemo_courses_patient ON chemo_courses(patient_id, cycle);
+CREATE INDEX IF NOT EXISTS idx_chemo_assessments_patient ON chemo_assessments(patient_id);
+"""
+
+_DB_READY = False
 
 
 def init_db():
+    # main() เรียกทุก rerun — ถ้า process นี้ setup ไปแล้วไม่ต้องยิง DDL ซ้ำ
+    global _DB_READY
+    if _DB_READY:
+        return
+
     conn = get_conn()
+    # ยิง DDL ทั้งก้อนด้วย executescript — parse ครั้งเดียว ไม่ใช่ execute ทีละ statement
+    conn.executescript(_SCHEMA_SQL)
     c = conn.cursor()
-    c.execute(
-        """
-    CREATE TABLE IF NOT EXISTS hospitals(
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        name TEXT NOT NULL UNIQUE
-    )
-    """
-    )
-    c.execute(
-        """
-    CREATE TABLE IF NOT EXISTS wards(
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        hospital_id INTEGER NOT NULL,
-        name TEXT NOT NULL,
-        FOREIGN KEY(hospital_id) REFERENCES hospitals(id)
-    )
-    """
-    )
-    c.execute(
-        """
-    CREATE TABLE IF NOT EXISTS patients(
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        patient_name TEXT NOT NULL,
-        mrn TEXT,
-        age INTEGER,
-        sex TEXT,
-        hospital_id INTEGER,
-        ward_id INTEGER,
-        status TEXT,
-        planned_admit_date TEXT,
-        admit_date TEXT,
-        bed TEXT,
-        diagnosis TEXT,
-        responsible_md TEXT,
-        priority TEXT,
-        precautions TEXT,
-        notes TEXT,
-        last_rounded_at TEXT,
-        weight_kg REAL,
-        height_cm REAL,
-        bsa REAL,
-        chemo_regimen TEXT,
-        chemo_total_cycles INTEGER,
-        chemo_interval_days INTEGER,
-        FOREIGN KEY(hospital_id) REFERENCES hospitals(id),
-        FOREIGN KEY(ward_id) REFERENCES wards(id)
-    )
-    """
-    )
-    c.execute(
-        """
-    CREATE TABLE IF NOT EXISTS rounds(
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        patient_id INTEGER NOT NULL,
-        round_time TEXT NOT NULL,
-        recorder TEXT,
-        notes TEXT,
-        FOREIGN KEY(patient_id) REFERENCES patients(id)
-    )
-    """
-    )
-    c.execute(
-        """
-    CREATE TABLE IF NOT EXISTS transfers(
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        patient_id INTEGER NOT NULL,
-        from_hospital_id INTEGER,
-        from_ward_id INTEGER,
-        to_hospital_id INTEGER,
-        to_ward_id INTEGER,
-        transfer_time TEXT NOT NULL,
-        notes TEXT,
-        FOREIGN KEY(patient_id) REFERENCES patients(id)
-    )
-    """
-    )
-    c.execute(
-        """
-    CREATE TABLE IF NOT EXISTS chemo_courses(
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        patient_id INTEGER NOT NULL,
-        cycle INTEGER NOT NULL,
-        date TEXT NOT NULL,
-        regimen TEXT NOT NULL,
-        drug TEXT NOT NULL,
-        dose_mg REAL,
-        dose_factor REAL,
-        notes TEXT,
-        FOREIGN KEY(patient_id) REFERENCES patients(id)
-    )
-    """
-    )
-
-    c.execute(
-    """
-    CREATE TABLE IF NOT EXISTS chemo_drugs(
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        course_id INTEGER NOT NULL,
-        regimen_day TEXT NOT NULL,
-        drug_name TEXT NOT NULL,
-        dose_mg REAL,
-        dose_factor REAL DEFAULT 1.0,
-        notes TEXT,
-        FOREIGN KEY(course_id) REFERENCES chemo_courses(id)
-    )
-    """
-    )
-    c.execute(
-        """
-    CREATE TABLE IF NOT EXISTS chemo_assessments(
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        patient_id INTEGER NOT NULL,
-        cycle_no INTEGER,
-        assess_date TEXT NOT NULL,
-        assess_type TEXT,
-        result_summary TEXT,
-        response TEXT,
-        FOREIGN KEY(patient_id) REFERENCES patients(id)
-    )
-    """
-    )
-    conn.commit()
-    # seed default hospital if none
+    # seed default hospital if none — executemany เผื่อเพิ่ม default หลายแห่งภายหลัง
     c.execute("SELECT COUNT(*) FROM hospitals")
     if c.fetchone()[0] == 0:
-        c.execute("INSERT INTO hospitals(name) VALUES (?)", ("ศิริราช",))
-        conn.commit()
-    conn.close()
+        c.executemany("INSERT INTO hospitals(name) VALUES (?)", [("ศิริราช",)])
+    conn.commit()
+    _DB_READY = True
 
 
 from typing import Any   # ถ้ายังไม่มี import นี้ อยู่บน ๆ ไฟล์เพิ่มบรรทัดนี้ด้วย
@@ -210,8 +227,6 @@ def fetch_df(sql: str, params: Any = None) -> pd.DataFrame:
     except Exception as e:
         st.warning(f"⚠️ Database error (fetch_df): {e}")
         return pd.DataFrame()
-    finally:
-        conn.close()
 
 
 def execute(sql: str, params: tuple = ()) -> None:
@@ -219,29 +234,88 @@ def execute(sql: str, params: tuple = ()) -> None:
     c = conn.cursor()
     c.execute(sql, params)
     conn.commit()
-    conn.close()
 
 
+def fetch_rows(sql: str, params: tuple = ()) -> List[sqlite3.Row]:
+    """
+    ดึงผลลัพธ์เป็น list ของ sqlite3.Row ตรง ๆ
+    ใช้กับงานที่แค่ loop สร้าง label/dict — ไม่ต้องจ่ายค่าสร้าง DataFrame
+    """
+    cur = get_conn().cursor()
+    cur.row_factory = sqlite3.Row
+    cur.execute(sql, params)
+    return cur.fetchall()
+
+
+def scalar(sql: str, params: tuple = ()):
+    """อ่านค่าตัวเดียว (เช่น COUNT/MAX) ด้วย cursor ตรง ๆ ไม่ต้องสร้าง DataFrame"""
+    cur = get_conn().cursor()
+    cur.execute(sql, params)
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+@st.cache_data(show_spinner=False)
+def get_hospitals() -> pd.DataFrame:
+    """รายชื่อโรงพยาบาล (เปลี่ยนไม่บ่อย) — cache ไว้ แล้วค่อย .clear() ตอนเพิ่ม/แก้"""
+    return fetch_df("SELECT id, name FROM hospitals ORDER BY name")
+
+
+@st.cache_data(show_spinner=False)
+def get_wards(hospital_id: int) -> pd.DataFrame:
+    """รายชื่อวอร์ดของ รพ. หนึ่ง ๆ — cache ต่อ hospital_id"""
+    return fetch_df(
+        "SELECT id, name FROM wards WHERE hospital_id=? ORDER BY name",
+        (hospital_id,),
+    )
+
+
+@st.cache_data(show_spinner=False)
+def get_hospital_name_to_id() -> Dict[str, int]:
+    """map ชื่อ รพ. -> id สร้างครั้งเดียวแล้ว cache ไม่ต้อง zip ใหม่ทุก rerun"""
+    df = get_hospitals()
+    return dict(zip(df["name"], df["id"]))
+
+
+@st.cache_data(show_spinner=False)
+def get_ward_name_to_id(hospital_id: int) -> Dict[str, int]:
+    """map ชื่อวอร์ด -> id ของ รพ. หนึ่ง ๆ"""
+    df = get_wards(hospital_id)
+    return dict(zip(df["name"], df["id"]))
+
+
+@lru_cache(maxsize=1024)
 def calc_bsa(weight_kg: float, height_cm: float) -> float:
+    # memoize — ทุก keystroke ใน number_input ทำให้ rerun แล้วเรียกซ้ำด้วยค่าเดิม
     if not weight_kg or not height_cm:
         return 0.0
-    return (weight_kg * height_cm / 3600) ** 0.5
+    return math.sqrt(weight_kg * height_cm / 3600)
 
 
 def get_patient(pid: int) -> dict:
     conn = get_conn()
-    conn.row_factory = sqlite3.Row
     c = conn.cursor()
-    c.execute("SELECT * FROM patients WHERE id=?", (pid,))
+    c.row_factory = sqlite3.Row
+    # join ชื่อ รพ./วอร์ด มาในแถวเดียวเลย ไม่ต้องยิง query แยกตอน render header
+    c.execute(
+        """
+        SELECT p.*, h.name AS hospital_name, w.name AS ward_name
+        FROM patients p
+        LEFT JOIN hospitals h ON p.hospital_id = h.id
+        LEFT JOIN wards w ON p.ward_id = w.id
+        WHERE p.id=?
+        """,
+        (pid,),
+    )
     row = c.fetchone()
-    conn.close()
     return dict(row) if row else {}
 
 
+@st.cache_data(show_spinner=False)
 def get_chemo_courses(pid: int) -> pd.DataFrame:
     """
-    ดึงประวัติ chemo ของผู้ป่วยจาก chemo_courses
-    คืนคอลัมน์ที่ show_chemo_tab ใช้:
+    ดึงประวัติ chemo ของผู้ป่วยจาก chemo_courses (cache ต่อ pid
+    เคลียร์ตอนบันทึก cycle ใหม่) คืนคอลัมน์ที่ show_chemo_tab ใช้:
       cycle, d1_date, regimen, day_label, drug, dose_mg, note
     """
     sql = """
@@ -258,24 +332,18 @@ def get_chemo_courses(pid: int) -> pd.DataFrame:
     ORDER BY cycle, date, id
     """
     return fetch_df(sql, (pid,))
-    
-    # ตรวจว่าตาราง chemo_cycles มีคอลัมน์อะไรบ้าง
-    table_info = fetch_df("PRAGMA table_info(chemo_cycles)")
-    existing_cols = set(table_info["name"].tolist())
 
-    # เลือกเฉพาะคอลัมน์ที่มีอยู่จริง
-    available = [c for c in required_cols if c in existing_cols]
 
-    col_str = ", ".join(available)
+ROUNDS_PAGE_SIZE = 20
+
 
+@st.cache_data(show_spinner=False)
+def get_rounds(pid: int, page: int = 1) -> pd.DataFrame:
+    """ประวัติการ round ของผู้ป่วยทีละหน้า (cache ต่อ pid/page เคลียร์ตอนบันทึก round ใหม่)"""
     return fetch_df(
-        f"""
-        SELECT {col_str}
-        FROM chemo_cycles
-        WHERE patient_id = ?
-        ORDER BY cycle, id
-        """,
-        (pid,),
+        "SELECT round_time, recorder, notes FROM rounds "
+        "WHERE patient_id=? ORDER BY round_time DESC LIMIT ? OFFSET ?",
+        (pid, ROUNDS_PAGE_SIZE, (page - 1) * ROUNDS_PAGE_SIZE),
     )
 
 
@@ -291,76 +359,72 @@ def add_chemo_from_df(
     - 1 แถวใน chemo_courses = 1 drug
     - คำนวณ dose จาก mg + เปอร์เซ็นต์ แล้วเก็บทั้ง dose_mg (จริง) และ dose_factor
     """
-    conn = get_conn()
-    c = conn.cursor()
+    if df.empty:
+        return
 
-    for _, r in df.iterrows():
-        # ---- ชื่อยา ----
-        drug = str(r.get("Drug") or "").strip()
-        if not drug:
-            # ถ้าไม่ได้กรอกชื่อยา ข้ามแถวนี้ไป
-            continue
+    work = df.copy()
 
-        # ---- ขนาดยา base เป็น mg ----
-        base_dose = r.get("Dose_mg")
-        try:
-            base_dose = float(base_dose) if base_dose not in (None, "") else None
-        except (TypeError, ValueError):
-            base_dose = None
+    # ---- ชื่อยา: ตัดแถวที่ไม่ได้กรอกออกทีเดียว ----
+    work["Drug"] = work.get("Drug", pd.Series(dtype=str)).fillna("").astype(str).str.strip()
+    work = work[work["Drug"] != ""]
+    if work.empty:
+        return
 
-        # ---- เปอร์เซ็นต์ขนาดยา (เช่น 80 = 80%) ----
-        dose_pct = r.get("Dose_%")
-        try:
-            dose_pct = float(dose_pct) if dose_pct not in (None, "") else 100.0
-        except (TypeError, ValueError):
-            dose_pct = 100.0
-
-        # คำนวณ dose จริง และ factor
-        final_dose = None
-        dose_factor = None
-        if base_dose is not None:
-            dose_factor = dose_pct / 100.0
-            final_dose = base_dose * dose_factor
-
-        # ---- note ----
-        notes = str(r.get("Notes") or "").strip()
-
-        # ---- บันทึกลง chemo_courses ----
-        c.execute(
-            """
-            INSERT INTO chemo_courses(
-                patient_id,
-                cycle,
-                date,
-                regimen,
-                drug,
-                dose_mg,
-                dose_factor,
-                notes
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            """,
-            (
-                pid,
-                int(cycle_no),
-                given_date.isoformat(),
-                regimen_name or "",
-                drug,
-                final_dose,
-                dose_factor,
-                notes or None,
-            ),
+    # ---- คำนวณ dose ทั้งตารางแบบ vectorized แทน loop ทีละแถว ----
+    base_dose = pd.to_numeric(work.get("Dose_mg"), errors="coerce")
+    dose_pct = pd.to_numeric(work.get("Dose_%"), errors="coerce").fillna(100.0)
+    dose_factor = dose_pct / 100.0
+    final_dose = base_dose * dose_factor
+    notes = work.get("Notes", pd.Series(dtype=str)).fillna("").astype(str).str.strip()
+
+    rows = [
+        (
+            pid,
+            int(cycle_no),
+            given_date.isoformat(),
+            regimen_name or "",
+            drug,
+            None if pd.isna(dose) else float(dose),
+            None if pd.isna(dose) else float(factor),
+            note or None,
         )
+        for drug, dose, factor, note in zip(work["Drug"], final_dose, dose_factor, notes)
+    ]
 
+    conn = get_conn()
+    conn.executemany(
+        """
+        INSERT INTO chemo_courses(
+            patient_id,
+            cycle,
+            date,
+            regimen,
+            drug,
+            dose_mg,
+            dose_factor,
+            notes
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+        rows,
+    )
     conn.commit()
-    conn.close()
+    get_chemo_courses.clear()
 
 
 def export_chemo_csv(pid: int, patient_name: str) -> bytes:
-    df = get_chemo_courses(pid)
-    if df.empty:
+    """สร้าง CSV ประวัติ chemo โดย stream จาก cursor ทีละแถว — ไม่ต้องสร้าง DataFrame"""
+    rows = fetch_rows(
+        "SELECT cycle, date, regimen, 'D1', drug, dose_mg, notes "
+        "FROM chemo_courses WHERE patient_id = ? ORDER BY cycle, date, id",
+        (pid,),
+    )
+    if not rows:
         return b""
-    df.insert(0, "Patient", patient_name)
-    return df.to_csv(index=False).encode("utf-8")
+    out = io.StringIO()
+    w = csv.writer(out)
+    w.writerow(["Patient", "cycle", "d1_date", "regimen", "day_label", "drug", "dose_mg", "note"])
+    w.writerows([patient_name, *row] for row in rows)
+    return out.getvalue().encode("utf-8")
 
 
 # -------------- Streamlit UI ----------------
@@ -370,16 +434,10 @@ def page_add_patient():
     st.header("เพิ่มผู้ป่วย")
 
     # -------- เลือกรพ.ก่อน (นอกฟอร์ม) --------
-    hospitals = fetch_df("SELECT id, name FROM hospitals ORDER BY name")
-    hosp_map = {row["name"]: row["id"] for _, row in hospitals.iterrows()} if not hospitals.empty else {}
+    hosp_map = get_hospital_name_to_id()
     hosp_name = st.selectbox("โรงพยาบาล *", list(hosp_map.keys()) or [""])
     hospital_id = hosp_map.get(hosp_name)
 
-    wards = fetch_df(
-        "SELECT id, name FROM wards WHERE hospital_id=? ORDER BY name",
-        (hospital_id,),
-    ) if hospital_id else pd.DataFrame()
-
     with st.form("add_patient_form", clear_on_submit=True):
         col1, col2 = st.columns(2)
 
@@ -393,20 +451,17 @@ def page_add_patient():
         # -------- คอลัมน์ขวา: รพ., วอร์ด, priority, precautions --------
         with col2:
             # โหลด ward ตาม hospital_id ที่เลือกจากด้านบน
-            wards = fetch_df(
-                "SELECT id, name FROM wards WHERE hospital_id=? ORDER BY name",
-                (hospital_id,),
-            ) if hospital_id else pd.DataFrame()
+            ward_map = get_ward_name_to_id(int(hospital_id)) if hospital_id else {}
 
-            if not wards.empty:
+            if ward_map:
                 ward_key = f"ward_for_{hospital_id or 'none'}"
                 ward_name = st.selectbox(
                     "วอร์ด",
-                    [""] + wards["name"].tolist(),
+                    [""] + list(ward_map.keys()),
                     key=ward_key,
                 )
                 if ward_name:
-                    ward_id = int(wards.set_index("name").loc[ward_name, "id"])
+                    ward_id = int(ward_map[ward_name])
                 else:
                     ward_id = None
             else:
@@ -478,6 +533,7 @@ def page_add_patient():
                     notes or None,
                 ),
             )
+            clear_dashboard_caches()
             st.success("บันทึกผู้ป่วย (Admitted) เรียบร้อยแล้ว")
             st.rerun()
 
@@ -514,13 +570,19 @@ def page_add_patient():
                     notes or None,
                 ),
             )
+            get_planned_patients.clear()
+            clear_dashboard_caches()
             st.success("บันทึก 'แผน Admit' เรียบร้อยแล้ว")
             st.rerun()
 
 
-def page_plan_admit():
-    st.header("แผน Admit")
-    df = fetch_df(
+PLAN_PAGE_SIZE = 20
+
+
+@st.cache_data(show_spinner=False)
+def get_planned_patients(page: int = 1) -> pd.DataFrame:
+    """รายการผู้ป่วยสถานะ Planned ทีละหน้า (cache — เคลียร์ทุกจุดที่เพิ่ม/แก้/ลบแผน)"""
+    return fetch_df(
         """
         SELECT p.id, p.patient_name, p.mrn,
                p.planned_admit_date, p.hospital_id, p.ward_id, p.status,
@@ -530,48 +592,68 @@ def page_plan_admit():
         LEFT JOIN wards w ON p.ward_id=w.id
         WHERE p.status='Planned'
         ORDER BY p.planned_admit_date, p.patient_name
-        """
+        LIMIT ? OFFSET ?
+        """,
+        (PLAN_PAGE_SIZE, (page - 1) * PLAN_PAGE_SIZE),
     )
 
-    if df.empty:
+
+def page_plan_admit():
+    st.header("แผน Admit")
+
+    # นับก่อนด้วย COUNT เบา ๆ — ไม่มีแผนก็ไม่ต้องสร้าง DataFrame เลย
+    n_planned = scalar("SELECT COUNT(*) FROM patients WHERE status='Planned'")
+    if not n_planned:
         st.info("ยังไม่มีผู้ป่วยที่วางแผน admit")
         return
 
-    for _, row in df.iterrows():
+    n_pages = max(1, -(-n_planned // PLAN_PAGE_SIZE))
+    page = 1
+    if n_pages > 1:
+        page = st.number_input(
+            f"หน้า (ทั้งหมด {n_pages} หน้า)",
+            min_value=1,
+            max_value=n_pages,
+            value=1,
+            step=1,
+            key="plan_page",
+        )
+
+    df = get_planned_patients(int(page))
+
+    # itertuples แทน iterrows — ไม่ต้องสร้าง Series ใหม่ทุกแถวทุก rerun
+    for row in df.itertuples(index=False):
 
         # แปลง planned_admit_date จาก string -> date ถ้ามี
         try:
             default_plan_date = (
-                datetime.fromisoformat(row["planned_admit_date"]).date()
-                if row["planned_admit_date"]
+                datetime.fromisoformat(row.planned_admit_date).date()
+                if row.planned_admit_date
                 else date.today()
             )
         except Exception:
             default_plan_date = date.today()
 
-        with st.expander(f"{row['planned_admit_date']} – {row['patient_name']} ({row.get('hospital') or '-'})"):
-            st.write(f"HN: {row['mrn'] or '-'}")
+        with st.expander(f"{row.planned_admit_date} – {row.patient_name} ({row.hospital or '-'})"):
+            st.write(f"HN: {row.mrn or '-'}")
 
             # === แก้ไข Ward ===
-            wards = fetch_df(
-                "SELECT id, name FROM wards WHERE hospital_id=? ORDER BY name",
-                (row["hospital_id"],),
-            ) if row["hospital_id"] else pd.DataFrame()
+            ward_map = get_ward_name_to_id(int(row.hospital_id)) if row.hospital_id else {}
 
             col1, col2 = st.columns(2)
 
             with col1:
-                if not wards.empty:
-                    ward_names = [""] + wards["name"].tolist()
-                    current_ward_name = row["ward"] if row["ward"] in ward_names else ""
+                if ward_map:
+                    ward_names = [""] + list(ward_map.keys())
+                    current_ward_name = row.ward if row.ward in ward_names else ""
                     new_ward_name = st.selectbox(
                         "วอร์ด (แก้ไขได้)",
                         ward_names,
                         index=ward_names.index(current_ward_name) if current_ward_name in ward_names else 0,
-                        key=f"ward_select_{row['id']}",
+                        key=f"ward_select_{row.id}",
                     )
                     if new_ward_name:
-                        new_ward_id = int(wards.set_index("name").loc[new_ward_name, "id"])
+                        new_ward_id = int(ward_map[new_ward_name])
                     else:
                         new_ward_id = None
                 else:
@@ -583,7 +665,7 @@ def page_plan_admit():
                 new_plan_date = st.date_input(
                     "วันที่วางแผน admit",
                     value=default_plan_date,
-                    key=f"plan_date_{row['id']}",
+                    key=f"plan_date_{row.id}",
                 )
 
             # === ปุ่มบันทึก + Admit + ลบออกจากแผน ===
@@ -591,62 +673,80 @@ def page_plan_admit():
 
             # ปุ่มบันทึกแผน (แก้ ward/วันเฉย ๆ)
             with col_b1:
-                if st.button("บันทึกแผน\n(ยังไม่ admit)", key=f"btn_update_plan_{row['id']}"):
+                if st.button("บันทึกแผน\n(ยังไม่ admit)", key=f"btn_update_plan_{row.id}"):
                     execute(
                         "UPDATE patients SET ward_id=?, planned_admit_date=? WHERE id=?",
-                        (new_ward_id, new_plan_date.isoformat(), int(row["id"])),
+                        (new_ward_id, new_plan_date.isoformat(), int(row.id)),
                     )
+                    get_planned_patients.clear()
+                    clear_dashboard_caches()
                     st.success("อัปเดตแผน admit แล้ว")
                     st.rerun()
 
             # ปุ่ม Admit วันนี้
             with col_b2:
-                if st.button("Admit แล้ววันนี้", key=f"btn_admit_{row['id']}"):
+                if st.button("Admit แล้ววันนี้", key=f"btn_admit_{row.id}"):
                     execute(
                         "UPDATE patients SET status='Admitted', ward_id=?, admit_date=?, planned_admit_date=? WHERE id=?",
                         (
                             new_ward_id,
                             date.today().isoformat(),
                             new_plan_date.isoformat(),
-                            int(row["id"]),
+                            int(row.id),
                         ),
                     )
+                    get_planned_patients.clear()
+                    clear_dashboard_caches()
                     st.success("อัปเดตเป็น Admitted แล้ว")
                     st.rerun()
 
             # ปุ่มลบออกจากแผน (ลบ record นี้ทิ้งเลย)
             with col_b3:
-                if st.button("ลบออกจากแผน", key=f"btn_delete_{row['id']}"):
+                if st.button("ลบออกจากแผน", key=f"btn_delete_{row.id}"):
                     execute(
                         "DELETE FROM patients WHERE id=?",
-                        (int(row["id"]),),
+                        (int(row.id),),
                     )
+                    get_planned_patients.clear()
+                    clear_dashboard_caches()
                     st.success("ลบผู้ป่วยออกจากแผน admit แล้ว")
                     st.rerun()
 def sidebar_backup():
     st.sidebar.markdown("### 💾 Backup/Restore")
-    import os
 
     if os.path.exists(DB_PATH):
+        # WAL mode: เขียนล่าสุดยังค้างในไฟล์ -wal — checkpoint ก่อน ไม่งั้นไฟล์หลักไม่ครบ
+        get_conn().execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        # ส่ง file object ให้ streamlit อ่านเอง ไม่ต้อง .read() ทั้งไฟล์ค้างไว้เอง
         with open(DB_PATH, "rb") as f:
             st.sidebar.download_button(
                 "ดาวน์โหลดฐานข้อมูล (.db)",
-                data=f.read(),
+                data=f,
                 file_name="admit_planner.db",
                 mime="application/octet-stream",
             )
     up = st.sidebar.file_uploader("อัปโหลดฐานข้อมูล (.db) เพื่อกู้คืน", type=["db"])
     if up is not None:
+        # ปิด connection เดิมก่อนทับไฟล์ — ไม่งั้น WAL/-shm เก่าจะยังถูกใช้ทับข้อมูลที่กู้คืน
+        get_conn().close()
+        get_conn.clear()
+        for suffix in ("-wal", "-shm"):
+            try:
+                os.remove(DB_PATH + suffix)
+            except FileNotFoundError:
+                pass
+        # stream ลงไฟล์เป็น chunk ไม่ดูดทั้งไฟล์เข้า RAM ก่อน
         with open(DB_PATH, "wb") as f:
-            f.write(up.read())
+            shutil.copyfileobj(up, f, length=256 * 1024)
+        # ทิ้ง cache ทุกตัว — ข้อมูลเก่าก่อนกู้คืนห้ามโผล่อีก
+        st.cache_data.clear()
         st.sidebar.success("กู้คืนฐานข้อมูลแล้ว — กด R เพื่อ refresh หน้า")
 
 
-def page_dashboard():
-    st.header("รายชื่อผู้ป่วย")
-
-    # ---------- ตารางบน: รายชื่อผู้ป่วยแบบละเอียด ----------
-    df_detail = fetch_df("""
+@st.cache_data(ttl=30, show_spinner=False)
+def get_dashboard_detail() -> pd.DataFrame:
+    """ตารางรายชื่อบน dashboard — cache สั้น ๆ พอให้ทนการสลับหน้าไปมา"""
+    return fetch_df("""
         SELECT
             COALESCE(h.name, '-') AS hospital,
             p.patient_name,
@@ -656,7 +756,7 @@ def page_dashboard():
         LEFT JOIN hospitals h ON p.hospital_id = h.id
         LEFT JOIN wards w     ON p.ward_id     = w.id
         ORDER BY
-            CASE 
+            CASE
                 WHEN p.status = 'Admitted' THEN 1
                 WHEN p.status = 'Discharged' THEN 2
                 ELSE 3
@@ -665,6 +765,32 @@ def page_dashboard():
             p.patient_name
     """)
 
+
+@st.cache_data(ttl=30, show_spinner=False)
+def get_dashboard_summary() -> pd.DataFrame:
+    """ยอดนับตาม รพ./สถานะ สำหรับ pivot — cache สั้น ๆ เช่นเดียวกับตารางบน"""
+    return fetch_df(
+        """
+        SELECT COALESCE(h.name, '-') AS hospital, p.status, COUNT(*) AS n
+        FROM patients p
+        LEFT JOIN hospitals h ON p.hospital_id = h.id
+        GROUP BY h.name, p.status
+        """
+    )
+
+
+def clear_dashboard_caches():
+    """เรียกทุกครั้งหลังเขียนตาราง patients — roster ต้องไม่โชว์ข้อมูลค้าง (TTL เป็นแค่กันเหนียว)"""
+    get_dashboard_detail.clear()
+    get_dashboard_summary.clear()
+
+
+def page_dashboard():
+    st.header("รายชื่อผู้ป่วย")
+
+    # ---------- ตารางบน: รายชื่อผู้ป่วยแบบละเอียด ----------
+    df_detail = get_dashboard_detail()
+
     if df_detail.empty:
         st.info("ยังไม่มีข้อมูลผู้ป่วย")
         return
@@ -675,12 +801,8 @@ def page_dashboard():
     # ---------- ตารางล่าง: Pivot ----------
     st.subheader("สรุปตามโรงพยาบาล (Pivot)")
 
-    df_summary = (
-        df_detail
-        .groupby(["hospital", "status"])
-        .size()
-        .reset_index(name="n")
-    )
+    # นับใน SQL ทีเดียว (GROUP BY) แล้วค่อย pivot — ไม่ต้อง groupby DataFrame ใหญ่ซ้ำ
+    df_summary = get_dashboard_summary()
 
     pivot = (
         df_summary
@@ -692,23 +814,24 @@ def page_dashboard():
     st.dataframe(pivot, use_container_width=True)
     
 def patient_selector() -> int:
-    df = fetch_df(
+    # ต่อ label ใน SQL เลย — Python ฝั่งนี้เหลือแค่ map label -> id
+    rows = fetch_rows(
         """
-        SELECT p.id, patient_name, mrn, status, h.name AS hospital, w.name AS ward
+        SELECT p.id,
+               p.patient_name || ' | ' || COALESCE(p.mrn, '-') || ' | '
+                   || COALESCE(h.name, '') || ' ' || COALESCE(w.name, '')
+                   || ' | ' || p.status AS label
         FROM patients p
         LEFT JOIN hospitals h ON p.hospital_id=h.id
         LEFT JOIN wards w ON p.ward_id=w.id
         WHERE p.status = 'Admitted'
-        ORDER BY w.name, patient_name
+        ORDER BY w.name, p.patient_name
         """
     )
-    if df.empty:
+    if not rows:
         st.info("ยังไม่มีผู้ป่วย")
         return 0
-    options = {
-        f"{row['patient_name']} | {row['mrn'] or '-'} | {row['hospital'] or ''} {row['ward'] or ''} | {row['status']}": int(row["id"])
-        for _, row in df.iterrows()
-    }
+    options = {r["label"]: int(r["id"]) for r in rows}
     label = st.selectbox("เลือกผู้ป่วย", list(options.keys()))
     return options[label]
 
@@ -716,14 +839,12 @@ def export_patient_selector() -> int:
     """
     ใช้สำหรับหน้า Export – เลือกผู้ป่วยได้ทั้ง Admitted / Discharged
     """
-    df = fetch_df(
+    rows = fetch_rows(
         """
         SELECT p.id,
-               p.patient_name,
-               p.mrn,
-               p.status,
-               h.name AS hospital,
-               w.name AS ward
+               p.patient_name || ' | ' || COALESCE(p.mrn, '-') || ' | '
+                   || COALESCE(h.name, '') || ' ' || COALESCE(w.name, '')
+                   || ' | ' || p.status AS label
         FROM patients p
         LEFT JOIN hospitals h ON p.hospital_id = h.id
         LEFT JOIN wards w ON p.ward_id = w.id
@@ -732,41 +853,15 @@ def export_patient_selector() -> int:
         """
     )
 
-    if df.empty:
+    if not rows:
         st.info("ยังไม่มีผู้ป่วยในระบบ")
         return 0
 
-    options: dict[str, int] = {}
-    for _, row in df.iterrows():
-        label = (
-            f"{row['patient_name']} | "
-            f"{row['mrn'] or '-'} | "
-            f"{row['hospital'] or ''} {row['ward'] or ''} | "
-            f"{row['status']}"
-        )
-        options[label] = int(row["id"])
+    options = {r["label"]: int(r["id"]) for r in rows}
 
     label = st.selectbox("เลือกผู้ป่วย (ทุกสถานะ)", list(options.keys()))
     return options[label]
 
-# ------------------------ helper: convert hospital/ward id to names ------------------------
-def get_hosp_ward_names(hospital_id: int | None, ward_id: int | None) -> tuple[str, str]:
-    hosp_name = "-"
-    ward_name = "-"
-
-    if hospital_id:
-        df_h = fetch_df("SELECT name FROM hospitals WHERE id=?", (hospital_id,))
-        if not df_h.empty:
-            hosp_name = df_h.loc[0]["name"]
-
-    if ward_id:
-        df_w = fetch_df("SELECT name FROM wards WHERE id=?", (ward_id,))
-        if not df_w.empty:
-            ward_name = df_w.loc[0]["name"]
-
-    return hosp_name, ward_name
-# ------------------------------------------------------------------------------------------
-
 def page_patient_detail():
     st.header("รายละเอียดผู้ป่วย / Rounds / Chemo / D/C")
     pid = patient_selector()
@@ -781,11 +876,9 @@ def page_patient_detail():
         f"**ชื่อ:** {data['patient_name']}  |  **HN:** {data.get('mrn') or '-'}  "
         f"|  **สถานะ:** {data.get('status') or '-'}"
     )
-    # แปลง hospital_id / ward_id → ชื่อจริง
-    hosp_name, ward_name = get_hosp_ward_names(
-        data.get("hospital_id"),
-        data.get("ward_id"),
-    )
+    # ชื่อ รพ./วอร์ด join มากับ get_patient แล้ว
+    hosp_name = data.get("hospital_name") or "-"
+    ward_name = data.get("ward_name") or "-"
 
     st.markdown(
         f"**โรงพยาบาล/วอร์ด:** {hosp_name} / {ward_name} "
@@ -800,29 +893,20 @@ def page_patient_detail():
         hosp_id = data["hospital_id"]
         current_ward_id = data.get("ward_id")
 
-        wards = fetch_df(
-            """
-            SELECT id, name
-            FROM wards
-            WHERE hospital_id = ?
-            ORDER BY name
-            """,
-            (hosp_id,),
-        )
+        ward_map = get_ward_name_to_id(int(hosp_id)) if hosp_id else {}
 
-        if wards.empty:
+        if not ward_map:
             st.info("รพ.นี้ยังไม่มีข้อมูลวอร์ดในฐานข้อมูล")
         else:
-            ward_map = {row["name"]: row["id"] for _, row in wards.iterrows()}
             ward_names = list(ward_map.keys())
 
             # default index
             default_index = 0
             if current_ward_id:
                 try:
-                    current_name = wards.set_index("id").loc[current_ward_id, "name"]
+                    current_name = {v: k for k, v in ward_map.items()}[current_ward_id]
                     default_index = ward_names.index(current_name)
-                except:
+                except (KeyError, ValueError):
                     pass
 
             new_ward_name = st.selectbox("วอร์ดใหม่", ward_names, index=default_index)
@@ -838,6 +922,7 @@ def page_patient_detail():
                     """,
                     (new_ward_id, new_bed or None, pid),
                 )
+                clear_dashboard_caches()
                 st.success("บันทึกการย้ายวอร์ด / เตียงเรียบร้อยแล้ว")
                 st.rerun()
 
@@ -850,12 +935,20 @@ def page_patient_detail():
         show_dc_tab(pid, data)
 
 
+@st.fragment
 def show_rounds_tab(pid: int):
     st.subheader("บันทึกการ round")
-    df = fetch_df(
-        "SELECT round_time, recorder, notes FROM rounds WHERE patient_id=? ORDER BY round_time DESC",
-        (pid,),
+    n_rounds = scalar("SELECT COUNT(*) FROM rounds WHERE patient_id=?", (pid,)) or 0
+    n_pages = max(1, -(-n_rounds // ROUNDS_PAGE_SIZE))
+    page = st.number_input(
+        f"หน้า (ทั้งหมด {n_pages} หน้า)",
+        min_value=1,
+        max_value=n_pages,
+        value=1,
+        step=1,
+        key=f"rounds_page_{pid}",
     )
+    df = get_rounds(pid, int(page))
     if not df.empty:
         st.dataframe(df, use_container_width=True)
     with st.form("add_round_form", clear_on_submit=True):
@@ -864,18 +957,25 @@ def show_rounds_tab(pid: int):
         submitted = st.form_submit_button("บันทึกบันทึกการ round")
         if submitted:
             now = datetime.now().isoformat(timespec="seconds")
-            execute(
-                "INSERT INTO rounds(patient_id, round_time, recorder, notes) VALUES (?,?,?,?)",
-                (pid, now, recorder or None, notes or None),
-            )
-            execute(
-                "UPDATE patients SET last_rounded_at=? WHERE id=?",
-                (now, pid),
-            )
+            # insert log + update last_rounded_at เป็น transaction เดียว
+            # (commit ครั้งเดียว และไม่มีจังหวะที่สองตารางไม่ตรงกัน)
+            conn = get_conn()
+            with conn:
+                conn.execute(
+                    "INSERT INTO rounds(patient_id, round_time, recorder, notes) VALUES (?,?,?,?)",
+                    (pid, now, recorder or None, notes or None),
+                )
+                conn.execute(
+                    "UPDATE patients SET last_rounded_at=? WHERE id=?",
+                    (now, pid),
+                )
+            get_rounds.clear()
             st.success("บันทึก round แล้ว")
-            st.rerun()
+            # refresh เฉพาะ fragment นี้พอ ตารางอื่นไม่ได้เปลี่ยน
+            st.rerun(scope="fragment")
 
 
+@st.fragment
 def show_chemo_tab(pid: int, data: dict):
     st.subheader("ข้อมูลร่างกาย (สำหรับคำนวณ dose)")
     col1, col2, col3 = st.columns(3)
@@ -887,11 +987,23 @@ def show_chemo_tab(pid: int, data: dict):
         bsa = calc_bsa(weight, height)
         st.metric("BSA (m²)", f"{bsa:.2f}" if bsa else "-")
     if st.button("บันทึกข้อมูลร่างกาย", key="btn_save_body"):
-        execute(
-            "UPDATE patients SET weight_kg=?, height_cm=?, bsa=? WHERE id=?",
-            (weight or None, height or None, bsa or None, pid),
+        # ถ้าค่าไม่ต่างจากที่เก็บไว้ ไม่ต้องเสีย write/fsync เปล่า ๆ
+        unchanged = all(
+            math.isclose(new or 0.0, old or 0.0, abs_tol=1e-6)
+            for new, old in (
+                (weight, data.get("weight_kg")),
+                (height, data.get("height_cm")),
+                (bsa, data.get("bsa")),
+            )
         )
-        st.success("บันทึกแล้ว")
+        if unchanged:
+            st.info("ข้อมูลร่างกายเหมือนเดิม ไม่ต้องบันทึกซ้ำ")
+        else:
+            execute(
+                "UPDATE patients SET weight_kg=?, height_cm=?, bsa=? WHERE id=?",
+                (weight or None, height or None, bsa or None, pid),
+            )
+            st.success("บันทึกแล้ว")
 
 
     # ------------------ ประวัติการให้ยาเคมีบำบัด ------------------
@@ -974,13 +1086,14 @@ def show_chemo_tab(pid: int, data: dict):
 
         st.dataframe(df_display, use_container_width=True)
 
-        # ปุ่มโหลด CSV เก็บ backup / ส่งออกภายนอก
-        csv_bytes = df_display.to_csv(index=False).encode("utf-8-sig")
-        st.download_button(
-            "📥 ดาวน์โหลดประวัติเคมีบำบัด (CSV)",
-            data=csv_bytes,
-            file_name=f"chemo_history_{pid}.csv",
-        )
+        # ปุ่มโหลด CSV เก็บ backup / ส่งออกภายนอก — สร้างไฟล์ตอนกดขอเท่านั้น
+        if st.button("เตรียม CSV", key=f"btn_prepare_chemo_csv_{pid}"):
+            csv_bytes = df_display.to_csv(index=False).encode("utf-8-sig")
+            st.download_button(
+                "📥 ดาวน์โหลดประวัติเคมีบำบัด (CSV)",
+                data=csv_bytes,
+                file_name=f"chemo_history_{pid}.csv",
+            )
 
     # -----------------------------------------------------------------
     # -------------------------------
@@ -988,18 +1101,21 @@ def show_chemo_tab(pid: int, data: dict):
     # -------------------------------
     st.markdown("### เพิ่ม cycle ใหม่ (บันทึกยาเคมีบำบัด)")
 
-    # หาว่าเคยให้ถึง cycle ไหนแล้ว และดึงชื่อ regimen ล่าสุดมาเป็นค่าเริ่มต้น
-    if not chemo_df.empty:
-        max_cycle = int(chemo_df["cycle"].max())
-        if chemo_df["regimen"].notna().any():
-            last_regimen = str(chemo_df["regimen"].dropna().iloc[-1])
-        else:
-            last_regimen = ""
-    else:
-        max_cycle = 0
-        last_regimen = ""
+    # หาว่าเคยให้ถึง cycle ไหนแล้ว — ให้ SQLite หา MAX เอง ไม่ต้องพึ่ง chemo_df
+    next_cycle = int(
+        scalar(
+            "SELECT COALESCE(MAX(cycle), 0) FROM chemo_courses WHERE patient_id=?",
+            (pid,),
+        )
+    ) + 1
 
-    next_cycle = max_cycle + 1
+    # ดึงชื่อ regimen ล่าสุดมาเป็นค่าเริ่มต้น — ให้ SQL หาแถวล่าสุดเอง
+    last_regimen = scalar(
+        "SELECT regimen FROM chemo_courses "
+        "WHERE patient_id=? AND regimen IS NOT NULL "
+        "ORDER BY id DESC LIMIT 1",
+        (pid,),
+    ) or ""
 
     col1, col2, col3 = st.columns(3)
     with col1:
@@ -1069,63 +1185,61 @@ def show_chemo_tab(pid: int, data: dict):
         if calc_df["Drug"].astype(str).str.strip().eq("").all():
             st.error("กรุณากรอกชื่อยาอย่างน้อย 1 drug")
         else:
-            import sqlite3  # ถ้ายังไม่ได้ import ด้านบนไฟล์
+            # เตรียม params ทุก drug ก่อน แล้วยิง executemany ใน transaction เดียว
+            # (commit/fsync ครั้งเดียวต่อ cycle ไม่ใช่ครั้งต่อ drug)
+            params = []
+            for drug_name, dose_pct, final_dose_mg, note in zip(
+                calc_df["Drug"], calc_df["Dose_%"], calc_df["Final_dose_mg"], calc_df["Notes"]
+            ):
+                drug_name = str(drug_name).strip()
+                if not drug_name:
+                    continue  # ข้ามแถวที่ไม่กรอกชื่อยา
+
+                dose_percent = float(dose_pct) if pd.notnull(dose_pct) else 100.0
+                final_dose = (
+                    float(final_dose_mg)
+                    if pd.notnull(final_dose_mg)
+                    else 0.0          # กันไม่ให้เป็น None เผื่อ dose_mg NOT NULL
+                )
+                note_text = str(note).strip() if isinstance(note, str) and note else None
+
+                params.append(
+                    (
+                        int(pid),
+                        int(cycle_no),
+                        given_date.isoformat(),   # ไม่ควรเป็น None
+                        regimen or None,
+                        drug_name,
+                        final_dose,
+                        # แปลง % เป็น factor (เช่น 80% -> 0.8) เพื่อเก็บลง dose_factor
+                        dose_percent / 100.0,
+                        note_text,
+                    )
+                )
 
             conn = get_conn()
-            c = conn.cursor()
             try:
-                for _, row in calc_df.iterrows():
-                    drug_name = str(row["Drug"]).strip()
-                    if not drug_name:
-                        continue  # ข้ามแถวที่ไม่กรอกชื่อยา
-
-                    dose_percent = float(row["Dose_%"]) if pd.notnull(row["Dose_%"]) else 100.0
-                    final_dose_mg = (
-                        float(row["Final_dose_mg"])
-                        if pd.notnull(row["Final_dose_mg"])
-                        else 0.0          # กันไม่ให้เป็น None เผื่อ dose_mg NOT NULL
-                    )
-                    note_text = (
-                        str(row["Notes"]).strip()
-                        if isinstance(row["Notes"], str) and row["Notes"]
-                        else None
-                    )
-
-                    # แปลง % เป็น factor (เช่น 80% -> 0.8) เพื่อเก็บลง dose_factor
-                    dose_factor = dose_percent / 100.0
-
-                    c.execute(
-                        """
-                        INSERT INTO chemo_courses
-                            (patient_id, cycle, date, regimen, drug, dose_mg, dose_factor, notes)
-                        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                        """,
-                        (
-                            int(pid),
-                            int(cycle_no),
-                            given_date.isoformat(),   # ไม่ควรเป็น None
-                            regimen or None,
-                            drug_name,
-                            final_dose_mg,
-                            float(dose_factor),
-                            note_text,
-                        ),
-                    )
-
+                conn.executemany(
+                    """
+                    INSERT INTO chemo_courses
+                        (patient_id, cycle, date, regimen, drug, dose_mg, dose_factor, notes)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                    """,
+                    params,
+                )
                 conn.commit()
+                get_chemo_courses.clear()
                 st.success("บันทึก chemo cycle นี้เรียบร้อยแล้ว")
-                st.rerun()
+                st.rerun(scope="fragment")
 
             except sqlite3.IntegrityError as e:
                 conn.rollback()
                 # ตรงนี้จะเห็นข้อความจริงของ error แล้ว
                 st.error(f"บันทึก chemo ไม่สำเร็จ (IntegrityError): {e}")
 
-            finally:
-                conn.close()
-
     # -----------------------------------------------------------------
 
+@st.fragment
 def show_dc_tab(pid: int, data: dict):
     st.subheader("แผนจัดการผู้ป่วย (D/C และรอบถัดไป)")
     st.info(f"สถานะปัจจุบัน: **{data.get('status','-')}**")
@@ -1161,6 +1275,7 @@ def show_dc_tab(pid: int, data: dict):
                 """,
                 (extra_note, pid),
             )
+            clear_dashboard_caches()
             st.success("บันทึก D/C และแผน F/U OPD แล้ว (เคสนี้จะไม่อยู่ในรายชื่อที่ต้อง round อีก)")
             st.rerun()
     else:
@@ -1171,40 +1286,45 @@ def show_dc_tab(pid: int, data: dict):
                 extra_note = (
                     f"[D/C {dc_date.isoformat()}] Planned readmit on {next_admit_date.isoformat()}\n"
                 )
-                execute(
-                    """
-                    UPDATE patients
-                    SET status='Discharged',
-                        notes = COALESCE(notes,'') || ?
-                    WHERE id=?
-                    """,
-                    (extra_note, pid),
-                )
-                # create new planned admission with same info
-                execute(
-                    """
-                    INSERT INTO patients(
-                        patient_name, mrn, age, sex,
-                        hospital_id, ward_id,
-                        status, planned_admit_date, admit_date,
-                        bed, diagnosis, responsible_md,
-                        priority, precautions, notes,
-                        weight_kg, height_cm, bsa,
-                        chemo_regimen, chemo_total_cycles, chemo_interval_days
+                conn = get_conn()
+                # D/C + สร้างแผนรอบถัดไปต้องไปด้วยกัน — ทำใน transaction เดียว
+                with conn:
+                    conn.execute(
+                        """
+                        UPDATE patients
+                        SET status='Discharged',
+                            notes = COALESCE(notes,'') || ?
+                        WHERE id=?
+                        """,
+                        (extra_note, pid),
                     )
-                    SELECT
-                        patient_name, mrn, age, sex,
-                        hospital_id, ward_id,
-                        'Planned', ?, NULL,
-                        bed, diagnosis, responsible_md,
-                        priority, precautions,
-                        COALESCE(notes,'') || '\n[Auto-planned readmit from id ' || id || ']',
-                        weight_kg, height_cm, bsa,
-                        chemo_regimen, chemo_total_cycles, chemo_interval_days
-                    FROM patients WHERE id=?
-                    """,
-                    (next_admit_date.isoformat(), pid),
-                )
+                    # create new planned admission with same info
+                    conn.execute(
+                        """
+                        INSERT INTO patients(
+                            patient_name, mrn, age, sex,
+                            hospital_id, ward_id,
+                            status, planned_admit_date, admit_date,
+                            bed, diagnosis, responsible_md,
+                            priority, precautions, notes,
+                            weight_kg, height_cm, bsa,
+                            chemo_regimen, chemo_total_cycles, chemo_interval_days
+                        )
+                        SELECT
+                            patient_name, mrn, age, sex,
+                            hospital_id, ward_id,
+                            'Planned', ?, NULL,
+                            bed, diagnosis, responsible_md,
+                            priority, precautions,
+                            COALESCE(notes,'') || '\n[Auto-planned readmit from id ' || id || ']',
+                            weight_kg, height_cm, bsa,
+                            chemo_regimen, chemo_total_cycles, chemo_interval_days
+                        FROM patients WHERE id=?
+                        """,
+                        (next_admit_date.isoformat(), pid),
+                    )
+                get_planned_patients.clear()
+                clear_dashboard_caches()
                 st.success("บันทึก D/C และสร้างรายการ Planned admit รอบถัดไปแล้ว")
                 st.rerun()
 
@@ -1260,7 +1380,8 @@ def page_export_history():
         export_parts.append(df)
 
     # 5.3 รวมทั้งหมดแล้ว export เป็น CSV
-    if export_parts:
+    # สร้างไฟล์ตอนผู้ใช้กดขอเท่านั้น ไม่ต้อง concat+to_csv ทุก rerun
+    if export_parts and st.button("เตรียมไฟล์ CSV", key=f"btn_prepare_csv_{pid}"):
         export_df = pd.concat(export_parts, ignore_index=True)
         csv_bytes = export_df.to_csv(index=False).encode("utf-8-sig")
 
@@ -1273,6 +1394,28 @@ def page_export_history():
 
 def page_settings():
     st.header("Settings / Reminders")
+
+    # ---------- ผู้ป่วย Admitted ที่ยังไม่ได้ round วันนี้ ----------
+    # เช็ควันที่ใน SQL เลย (date(last_rounded_at)) ไม่ต้องดึงทุกแถวมา parse ใน Python
+    st.markdown("## 🔔 ยังไม่ได้ round วันนี้")
+    miss_df = fetch_df(
+        """
+        SELECT p.patient_name, COALESCE(h.name,'-') AS hospital, COALESCE(w.name,'-') AS ward
+        FROM patients p
+        LEFT JOIN hospitals h ON p.hospital_id=h.id
+        LEFT JOIN wards w ON p.ward_id=w.id
+        WHERE p.status='Admitted'
+          AND (p.last_rounded_at IS NULL
+               OR date(p.last_rounded_at) <> date('now','localtime'))
+        ORDER BY h.name, w.name, p.patient_name
+        """
+    )
+    if miss_df.empty:
+        st.success("ผู้ป่วย Admitted ทุกคนถูก round แล้ววันนี้")
+    else:
+        st.warning(f"ยังไม่ได้ round วันนี้ {len(miss_df)} ราย")
+        st.dataframe(miss_df, use_container_width=True)
+
     st.markdown("## จัดการโรงพยาบาลและวอร์ด")
     col1, col2 = st.columns(2)
     with col1:
@@ -1283,18 +1426,20 @@ def page_settings():
             if submitted and name:
                 try:
                     execute("INSERT INTO hospitals(name) VALUES (?)", (name,))
+                    get_hospitals.clear()
+                    get_hospital_name_to_id.clear()
                     st.success("เพิ่มโรงพยาบาลแล้ว")
                 except sqlite3.IntegrityError:
                     st.error("มีโรงพยาบาลชื่อนี้อยู่แล้ว")
-        hosp_df = fetch_df("SELECT id, name FROM hospitals ORDER BY name")
+        hosp_df = get_hospitals()
         st.dataframe(hosp_df, use_container_width=True)
     with col2:
         st.markdown("### วอร์ด")
-        hosp_df = fetch_df("SELECT id, name FROM hospitals ORDER BY name")
+        hosp_df = get_hospitals()
         if hosp_df.empty:
             st.info("ยังไม่มีโรงพยาบาล")
         else:
-            hosp_map = {row["name"]: row["id"] for _, row in hosp_df.iterrows()}
+            hosp_map = get_hospital_name_to_id()
             hosp_name = st.selectbox("เลือกโรงพยาบาลเพื่อเพิ่มวอร์ด", list(hosp_map.keys()))
             hospital_id = hosp_map[hosp_name]
             with st.form("add_ward_form", clear_on_submit=True):
@@ -1302,16 +1447,24 @@ def page_settings():
                 submitted = st.form_submit_button("เพิ่มวอร์ด")
                 if submitted and ward_name:
                     execute("INSERT INTO wards(hospital_id, name) VALUES (?,?)", (hospital_id, ward_name))
+                    get_wards.clear()
+                    get_ward_name_to_id.clear()
                     st.success("เพิ่มวอร์ดแล้ว")
-            ward_df = fetch_df(
-                "SELECT w.id, w.name FROM wards w WHERE w.hospital_id=? ORDER BY w.name",
-                (hospital_id,),
-            )
+            ward_df = get_wards(int(hospital_id))
             st.dataframe(ward_df, use_container_width=True)
             # ---------- แก้ไขหรือลบวอร์ด ----------
             if not ward_df.empty:
                 st.markdown("#### แก้ไข / ลบวอร์ด")
 
+                # นับผู้ป่วยต่อวอร์ดครั้งเดียวต่อ render — ปุ่มลบจะได้เช็คจาก dict ทันที
+                ward_use_map = {
+                    r["ward_id"]: r["cnt"]
+                    for r in fetch_rows(
+                        "SELECT ward_id, COUNT(*) AS cnt FROM patients "
+                        "WHERE ward_id IS NOT NULL GROUP BY ward_id"
+                    )
+                }
+
                 # เลือกวอร์ดก่อน
                 ward_name_list = ward_df["name"].tolist()
                 selected_ward_name = st.selectbox(
@@ -1320,9 +1473,8 @@ def page_settings():
                     key=f"edit_ward_select_{hospital_id}",
                 )
 
-                # หา ward_id ของวอร์ดที่เลือก
-                ward_row = ward_df[ward_df["name"] == selected_ward_name].iloc[0]
-                selected_ward_id = int(ward_row["id"])
+                # หา ward_id ของวอร์ดที่เลือก (ใช้ map แคชแทน boolean mask + iloc)
+                selected_ward_id = int(get_ward_name_to_id(int(hospital_id))[selected_ward_name])
 
                 # ช่องกรอกชื่อใหม่ (ค่าเริ่มต้นเป็นชื่อเดิม)
                 new_ward_name_edit = st.text_input(
@@ -1340,6 +1492,8 @@ def page_settings():
                             "UPDATE wards SET name=? WHERE id=?",
                             (new_ward_name_edit, selected_ward_id),
                         )
+                        get_wards.clear()
+                        get_ward_name_to_id.clear()
                         st.success("แก้ไขชื่อวอร์ดเรียบร้อยแล้ว")
                         st.rerun()
 
@@ -1347,17 +1501,15 @@ def page_settings():
                 with col_del:
                     if st.button("ลบวอร์ดนี้", key=f"btn_delete_ward_{selected_ward_id}"):
                         # เช็คก่อนว่ามีผู้ป่วยใช้วอร์ดนี้อยู่ไหม
-                        used_df = fetch_df(
-                            "SELECT COUNT(*) AS cnt FROM patients WHERE ward_id=?",
-                            (selected_ward_id,),
-                        )
-                        if used_df["cnt"].iloc[0] > 0:
+                        if ward_use_map.get(selected_ward_id, 0) > 0:
                             st.error("ไม่สามารถลบวอร์ดนี้ได้ เพราะมีผู้ป่วยที่ผูกกับวอร์ดนี้อยู่")
                         else:
                             execute(
                                 "DELETE FROM wards WHERE id=?",
                                 (selected_ward_id,),
                             )
+                            get_wards.clear()
+                            get_ward_name_to_id.clear()
                             st.success("ลบวอร์ดเรียบร้อยแล้ว")
                             st.rerun()
 